@@ -1,104 +1,358 @@
 import streamlit as st
+import asyncio
+import atexit
+import csv
+import io
 import cv2
-import pyzbar.pyzbar as pyzbar
-import json
+import orjson
 import os
 import logging
+import logging.handlers
+import queue
+import sqlite3
 import numpy as np
-import requests
-import pandas as pd
-import matplotlib.pyplot as plt
-
-# Setup logging to file
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("nutriscan.log")]
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# zxing-cpp is preferred; pyzbar (and libzbar) is only needed when it is missing
+try:
+    import zxingcpp
+except ImportError:
+    zxingcpp = None
+    import pyzbar.pyzbar as pyzbar
+    from pyzbar.pyzbar import ZBarSymbol
+
+@st.cache_resource
+def setup_logging():
+    """Log to nutriscan.log from a background thread so scans never wait on file writes."""
+    log_queue = queue.Queue(-1)
+    file_handler = logging.FileHandler("nutriscan.log")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    # The file handler applies the full format; the queue handler only merges args into the message
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    return listener
+
+# Setup logging to file (once per process; Streamlit re-executes this module on every rerun)
+setup_logging()
+
+OFF_PRODUCT_URL = "https://world.openfoodfacts.org/api/v0/product/{barcode}.json?fields=product_name,nutriments"
+OFF_SEARCH_URL = "https://world.openfoodfacts.org/api/v2/search"
+USER_AGENT = "NutriScan/1.0"
+
+# Nutrients shown in the history, checked against preferences, and their histogram colors
+NUTRIENTS = ("calories", "protein", "fat", "carbs", "sugar", "fiber")
+HIST_COLORS = ("skyblue", "lightgreen", "salmon", "gold", "violet", "lime")
+
+# Columns shown in the result table and written to the CSV export
+RESULT_COLUMNS = ["name", "calories", "fat", "carbs", "protein", "sugar", "fiber"]
+
+# Columns stored per barcode, in table order after the code itself
+DB_COLUMNS = ["name", "calories", "fat", "carbs", "protein", "sugar", "fiber", "etag"]
+INSERT_BARCODE_SQL = (
+    f"INSERT OR REPLACE INTO barcodes (code, {', '.join(DB_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * (len(DB_COLUMNS) + 1))})"
 )
 
-def load_nutrition_db():
-    """Load or create the local barcode cache."""
-    db_path = "nutrition_db.json"
-    if not os.path.exists(db_path):
-        logging.info(f"Creating {db_path}")
-        with open(db_path, "w") as f:
-            json.dump({"barcodes": {}}, f)
+def import_legacy_json(conn):
+    """Seed an empty barcodes table from the old nutrition_db.json cache."""
+    json_path = "nutrition_db.json"
+    if not os.path.exists(json_path):
+        return
     try:
-        with open(db_path, "r") as f:
-            logging.info(f"Loaded {db_path}")
-            return json.load(f)
+        with open(json_path, "rb") as f:
+            barcodes = orjson.loads(f.read()).get("barcodes", {})
+        conn.executemany(
+            INSERT_BARCODE_SQL,
+            [(code, *(item.get(c) for c in DB_COLUMNS)) for code, item in barcodes.items()]
+        )
+        logging.info(f"Imported {len(barcodes)} barcodes from {json_path}")
     except Exception as e:
-        logging.error(f"Failed to load {db_path}: {e}")
-        return {"barcodes": {}}
+        logging.error(f"Failed to import {json_path}: {e}")
 
-def save_nutrition_db(db):
-    """Save barcode cache to nutrition_db.json."""
+@st.cache_resource
+def get_db_connection():
+    """Open (and create if needed) the SQLite barcode cache, shared across sessions."""
+    db_path = "nutriscan.db"
+    conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS barcodes ("
+        "code TEXT PRIMARY KEY, name TEXT, calories REAL, fat REAL, "
+        "carbs REAL, protein REAL, sugar REAL, fiber REAL, etag TEXT)"
+    )
+    # Databases created before ETags were stored lack the column
+    if "etag" not in {row[1] for row in conn.execute("PRAGMA table_info(barcodes)")}:
+        conn.execute("ALTER TABLE barcodes ADD COLUMN etag TEXT")
+    if conn.execute("SELECT COUNT(*) FROM barcodes").fetchone()[0] == 0:
+        import_legacy_json(conn)
+    logging.info(f"Opened {db_path}")
+    return conn
+
+def row_to_dict(row):
+    """Convert a barcodes row (without code) to a nutrition dict, dropping NULLs."""
+    return {c: v for c, v in zip(DB_COLUMNS, row) if v is not None}
+
+def load_barcode(barcode):
+    """Load a single cached barcode, or None if it is not cached."""
     try:
-        with open("nutrition_db.json", "w") as f:
-            json.dump(db, f, indent=2)
-        logging.info("Saved nutrition_db.json")
+        row = get_db_connection().execute(
+            f"SELECT {', '.join(DB_COLUMNS)} FROM barcodes WHERE code = ?", (barcode,)
+        ).fetchone()
+        return row_to_dict(row) if row else None
     except Exception as e:
-        logging.error(f"Failed to save nutrition_db.json: {e}")
+        logging.error(f"Failed to load barcode {barcode}: {e}")
+        return None
 
-def fetch_barcode_data(barcode):
-    """Fetch nutritional data from Open Food Facts."""
+def save_barcode(barcode, data):
+    """Insert or update a single barcode in the cache."""
     try:
-        url = f"https://world.openfoodfacts.org/api/v0/product/{barcode}.json"
-        response = requests.get(url, timeout=5)
+        get_db_connection().execute(
+            INSERT_BARCODE_SQL,
+            (barcode, *(data.get(c) for c in DB_COLUMNS))
+        )
+        logging.info(f"Saved barcode {barcode}")
+    except Exception as e:
+        logging.error(f"Failed to save barcode {barcode}: {e}")
+
+def parse_product(barcode, data, etag=None):
+    """Extract nutritional data from an Open Food Facts product response."""
+    if data.get("status") != 1 or not data.get("product"):
+        logging.warning(f"No product found for barcode {barcode}")
+        return None
+    return product_to_nutrition(barcode, data["product"], etag)
+
+def product_to_nutrition(barcode, product, etag=None):
+    """Map an Open Food Facts product object to the cached nutrition fields."""
+    nutriments = product.get("nutriments", {})
+    result = {
+        "name": product.get("product_name", "Unknown Product"),
+        "calories": nutriments.get("energy-kcal_100g", 0),
+        "fat": nutriments.get("fat_100g", 0),
+        "carbs": nutriments.get("carbohydrates_100g", 0),
+        "protein": nutriments.get("proteins_100g", 0),
+        "sugar": nutriments.get("sugars_100g", 0),
+        "fiber": nutriments.get("fiber_100g", 0)
+    }
+    if etag:
+        result["etag"] = etag
+    logging.info(f"Fetched data for {barcode}: {result['name']}")
+    return result
+
+@st.cache_resource
+def get_http_session():
+    """Shared HTTP session so repeat scans reuse the Open Food Facts connection."""
+    import requests
+    session = requests.Session()
+    session.headers.update({"User-Agent": USER_AGENT})
+    return session
+
+def fetch_barcode_data(barcode, cached=None):
+    """Fetch nutritional data from Open Food Facts.
+
+    Pass the cached record to revalidate it: its ETag is sent as If-None-Match and
+    the record is returned unchanged on 304 Not Modified. Records without an ETag
+    (such as those saved from a batch search) get a plain, unconditional refetch.
+    """
+    try:
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        elif cached:
+            logging.info(f"No ETag cached for {barcode}, refetching unconditionally")
+        response = get_http_session().get(OFF_PRODUCT_URL.format(barcode=barcode), headers=headers, timeout=5)
+        if response.status_code == 304 and headers:
+            logging.info(f"Cached data for {barcode} not modified")
+            return cached
         if response.status_code != 200:
             logging.warning(f"Open Food Facts API failed for {barcode}: Status {response.status_code}")
             return None
-        data = response.json()
-        if data.get("status") != 1 or not data.get("product"):
-            logging.warning(f"No product found for barcode {barcode}")
-            return None
-        product = data["product"]
-        nutriments = product.get("nutriments", {})
-        result = {
-            "name": product.get("product_name", "Unknown Product"),
-            "calories": nutriments.get("energy-kcal_100g", 0),
-            "fat": nutriments.get("fat_100g", 0),
-            "carbs": nutriments.get("carbohydrates_100g", 0),
-            "protein": nutriments.get("proteins_100g", 0),
-            "sugar": nutriments.get("sugars_100g", 0),
-            "fiber": nutriments.get("fiber_100g", 0)
+        return parse_product(barcode, orjson.loads(response.content), response.headers.get("ETag"))
+    except Exception as e:
+        logging.error(f"Open Food Facts API error for {barcode}: {e}")
+        return None
+
+def fetch_barcode_batch(barcodes):
+    """Fetch several barcodes in one Open Food Facts search; returns {barcode: data} for those found.
+
+    Search results carry no per-product ETag, so these records can't be revalidated
+    conditionally; fetch_barcode_data refetches them in full instead. The search endpoint
+    is rate-limited far more tightly than product reads, so only call it for barcodes the
+    scan can actually reach (see prefetch_barcodes).
+    """
+    try:
+        params = {
+            "code": ",".join(barcodes),
+            "fields": "code,product_name,nutriments",
+            "page_size": len(barcodes)
         }
-        logging.info(f"Fetched data for {barcode}: {result['name']}")
-        return result
+        response = get_http_session().get(OFF_SEARCH_URL, params=params, timeout=5)
+        if response.status_code != 200:
+            logging.warning(f"Open Food Facts batch search failed: Status {response.status_code}")
+            return {}
+        products = orjson.loads(response.content).get("products", [])
+        wanted = set(barcodes)
+        return {p["code"]: product_to_nutrition(p["code"], p) for p in products if p.get("code") in wanted}
+    except Exception as e:
+        logging.error(f"Open Food Facts batch search error: {e}")
+        return {}
+
+async def fetch_barcode_data_async(http, barcode):
+    """Fetch nutritional data from Open Food Facts on a shared aiohttp session."""
+    try:
+        async with http.get(OFF_PRODUCT_URL.format(barcode=barcode)) as response:
+            if response.status != 200:
+                logging.warning(f"Open Food Facts API failed for {barcode}: Status {response.status}")
+                return None
+            data = await response.json(content_type=None, loads=orjson.loads)
+            etag = response.headers.get("ETag")
+        return parse_product(barcode, data, etag)
     except Exception as e:
         logging.error(f"Open Food Facts API error for {barcode}: {e}")
         return None
 
-def scan_barcode(image):
-    """Scan a barcode and return nutritional data with preprocessing."""
-    db = load_nutrition_db()
-    if not db:
+async def fetch_all_barcode_data(barcodes):
+    """Fetch several barcodes from Open Food Facts concurrently."""
+    timeout = aiohttp.ClientTimeout(total=5)
+    async with aiohttp.ClientSession(headers={"User-Agent": USER_AGENT}, timeout=timeout) as http:
+        return await asyncio.gather(*[fetch_barcode_data_async(http, b) for b in barcodes])
+
+def prefetch_barcodes(barcodes):
+    """Fetch and cache the uncached barcodes scan_barcode can reach, in as few round trips as possible.
+
+    scan_barcode returns the first barcode it resolves, so only the uncached barcodes before
+    the first cached one are fetched; if the first barcode is cached nothing is fetched.
+    Returns the barcodes already attempted, found or not, so callers don't fetch them again.
+    """
+    uncached = []
+    for barcode in dict.fromkeys(barcodes):
+        if is_cached(barcode):
+            break
+        uncached.append(barcode)
+    if len(uncached) < 2:
+        return set()
+    # One batched search first, spent only on reachable barcodes (and never when the
+    # first barcode is cached); anything it misses gets a concurrent per-barcode round
+    found = fetch_barcode_batch(uncached)
+    for barcode, nutritional_info in found.items():
+        save_barcode(barcode, nutritional_info)
+    uncached = [b for b in uncached if b not in found]
+    if len(uncached) < 2:
+        return set(found)
+    try:
+        if aiohttp is None:
+            raise RuntimeError("aiohttp not installed")
+        results = asyncio.run(fetch_all_barcode_data(uncached))
+    except Exception as e:
+        # Sequential lookups in scan_barcode still cover every barcode
+        logging.warning(f"Concurrent fetch unavailable, falling back to sequential: {e}")
+        return set(found)
+    for barcode, nutritional_info in zip(uncached, results):
+        if nutritional_info:
+            save_barcode(barcode, nutritional_info)
+    return set(found) | set(uncached)
+
+@st.cache_data(ttl=120)
+def load_barcode_cached(barcode):
+    """TTL-cached load_barcode; raises LookupError on a miss so misses are never cached."""
+    nutritional_info = load_barcode(barcode)
+    if not nutritional_info:
+        raise LookupError(barcode)
+    return nutritional_info
+
+def is_cached(barcode):
+    """Whether a barcode is in the local cache, going through the TTL layer first."""
+    try:
+        load_barcode_cached(barcode)
+        return True
+    except LookupError:
+        return False
+
+def lookup_barcode(barcode, fetch=True):
+    """Look up a barcode in the local cache, falling back to Open Food Facts if fetch is set."""
+    try:
+        nutritional_info = load_barcode_cached(barcode)
+        logging.info(f"Barcode {barcode} found in cache: {nutritional_info['name']}")
+        return nutritional_info
+    except LookupError:
+        pass
+    if not fetch:
         return None
+    nutritional_info = fetch_barcode_data(barcode)
+    if nutritional_info:
+        save_barcode(barcode, nutritional_info)
+    return nutritional_info
+
+# Food barcode formats (EAN-13/8, UPC-A/E, Code 128) for whichever decoder is installed;
+# leaving out PDF417, 2D and other linear codes keeps each pass cheap and avoids ITF false positives
+if zxingcpp is not None:
+    ZXING_FORMATS = (
+        zxingcpp.BarcodeFormat.EAN13 | zxingcpp.BarcodeFormat.EAN8 | zxingcpp.BarcodeFormat.UPCA
+        | zxingcpp.BarcodeFormat.UPCE | zxingcpp.BarcodeFormat.Code128
+    )
+else:
+    # UPC-A is not listed: zbar then reports it as 13-digit EAN13, matching the cached keys
+    BARCODE_SYMBOLS = [ZBarSymbol.EAN13, ZBarSymbol.EAN8, ZBarSymbol.UPCE, ZBarSymbol.CODE128]
+SCAN_WIDTH = 800
+RETRY_WIDTHS = [600, 1000, 1400]
+
+def resize_to_width(image_gray, width):
+    """Resize keeping aspect ratio, using INTER_AREA when shrinking."""
+    if image_gray.shape[1] == width:
+        return image_gray
+    height = int(image_gray.shape[0] * width / image_gray.shape[1])
+    interpolation = cv2.INTER_AREA if width < image_gray.shape[1] else cv2.INTER_LINEAR
+    return cv2.resize(image_gray, (width, height), interpolation=interpolation)
+
+def binarize(image_gray):
+    """Adaptive threshold to recover bars from low-contrast or unevenly lit photos."""
+    return cv2.adaptiveThreshold(image_gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10)
+
+def read_barcodes(image_gray):
+    """Return the barcode strings in an image, preferring zxing-cpp over pyzbar."""
+    if zxingcpp is not None:
+        results = zxingcpp.read_barcodes(image_gray, formats=ZXING_FORMATS)
+        # Keep UPC-A in the 13-digit EAN form used as the cache key
+        return [r.text.zfill(13) if r.format == zxingcpp.BarcodeFormat.UPCA else r.text for r in results]
+    return [b.data.decode("utf-8") for b in pyzbar.decode(image_gray, symbols=BARCODE_SYMBOLS)]
+
+def decode_barcodes(image_gray):
+    """Decode barcodes, retrying with thresholding and other scales when nothing is found."""
+    # Downscale wide images only; narrower ones are scanned as-is
+    image_scan = resize_to_width(image_gray, SCAN_WIDTH) if image_gray.shape[1] > SCAN_WIDTH else image_gray
+    barcodes = read_barcodes(image_scan)
+    if barcodes:
+        return barcodes
+    barcodes = read_barcodes(binarize(image_scan))
+    if barcodes:
+        logging.info("Decoded barcode after adaptive threshold")
+        return barcodes
+    for width in RETRY_WIDTHS:
+        barcodes = read_barcodes(binarize(resize_to_width(image_gray, width)))
+        if barcodes:
+            logging.info(f"Decoded barcode after retry at width {width}")
+            return barcodes
+    return []
+
+def scan_barcode(image_gray):
+    """Scan a barcode in a grayscale image and return nutritional data with preprocessing."""
     try:
-        # Preprocess: resize and grayscale
-        width = 800
-        aspect = image.shape[1] / image.shape[0]
-        height = int(width / aspect)
-        image_resized = cv2.resize(image, (width, height))
-        image_gray = cv2.cvtColor(image_resized, cv2.COLOR_BGR2GRAY)
-        barcodes = pyzbar.decode(image_gray)
+        barcodes = decode_barcodes(image_gray)
         if not barcodes:
             logging.info("No barcodes found in image")
             return None
-        for barcode in barcodes:
-            barcode_data = barcode.data.decode("utf-8")
-            if barcode.type == "PDF417":
-                logging.warning(f"Skipping unsupported PDF417 barcode: {barcode_data}")
-                st.warning(f"PDF417 barcode {barcode_data} not supported. Use UPC/EAN format.")
-                continue
-            nutritional_info = db["barcodes"].get(barcode_data)
+        prefetched = prefetch_barcodes(barcodes)
+        for barcode_data in barcodes:
+            nutritional_info = lookup_barcode(barcode_data, fetch=barcode_data not in prefetched)
             if nutritional_info:
-                logging.info(f"Barcode {barcode_data} found in cache: {nutritional_info['name']}")
-                return nutritional_info
-            nutritional_info = fetch_barcode_data(barcode_data)
-            if nutritional_info:
-                db["barcodes"][barcode_data] = nutritional_info
-                save_nutrition_db(db)
                 return nutritional_info
             logging.warning(f"Barcode {barcode_data} not found in Open Food Facts")
             st.warning(f"Barcode {barcode_data} not found in database or Open Food Facts.")
@@ -107,32 +361,86 @@ def scan_barcode(image):
         logging.error(f"Barcode scanning failed: {e}")
         return None
 
+# Preference checks per NUTRIENTS entry: 1 means the value is a maximum, -1 a minimum
+CHECK_SIGNS = np.array([1, -1, 1, 1, 1, -1])
+CHECK_OPS = tuple(">" if s > 0 else "<" for s in CHECK_SIGNS)
+
+# cache_resource rather than lru_cache: Streamlit re-executes this module on every rerun,
+# and it returns the closure itself instead of pickling it
+@st.cache_resource(max_entries=32)
+def make_checker(max_calories, min_protein, max_fat, max_carbs, max_sugar, min_fiber):
+    """Build a preference checker specialized on one set of slider values."""
+    thresholds = (max_calories, min_protein, max_fat, max_carbs, max_sugar, min_fiber)
+    # Flipping the sign turns every min check into a max check, so one comparison covers all
+    signed_thresholds = CHECK_SIGNS * np.array(thresholds, dtype=np.float64)
+
+    def check(data):
+        if not data:
+            return False, []
+        values = [data.get(k, 0) for k in NUTRIENTS]
+        bad = CHECK_SIGNS * np.array(values, dtype=np.float64) > signed_thresholds
+        if not bad.any():
+            return True, []
+        failures = [(NUTRIENTS[i], CHECK_OPS[i], thresholds[i], values[i]) for i in np.flatnonzero(bad)]
+        return False, [f"{k.capitalize()} ({v} {op} {t})" for k, op, t, v in failures]
+
+    return check
+
 def check_nutrition(data, max_calories, min_protein, max_fat, max_carbs, max_sugar, min_fiber):
     """Check if nutritional data meets user preferences with detailed feedback."""
-    if not data:
-        return False, []
-    mismatches = []
-    if data.get("calories", 0) > max_calories: mismatches.append(f"Calories ({data['calories']} > {max_calories})")
-    if data.get("protein", 0) < min_protein: mismatches.append(f"Protein ({data['protein']} < {min_protein})")
-    if data.get("fat", 0) > max_fat: mismatches.append(f"Fat ({data['fat']} > {max_fat})")
-    if data.get("carbs", 0) > max_carbs: mismatches.append(f"Carbs ({data['carbs']} > {max_carbs})")
-    if data.get("sugar", 0) > max_sugar: mismatches.append(f"Sugar ({data['sugar']} > {max_sugar})")
-    if data.get("fiber", 0) < min_fiber: mismatches.append(f"Fiber ({data['fiber']} < {min_fiber})")
-    return len(mismatches) == 0, mismatches
-
-def plot_nutrition_histogram(db):
+    return make_checker(max_calories, min_protein, max_fat, max_carbs, max_sugar, min_fiber)(data)
+
+def load_scan_history():
+    """Load key nutrients of all cached barcodes as a columnar DataFrame."""
+    import pandas as pd
+    try:
+        history = pd.read_sql(f"SELECT {', '.join(NUTRIENTS)} FROM barcodes", get_db_connection())
+        return history.fillna(0).astype(np.float64)
+    except Exception as e:
+        logging.error(f"Failed to load scan history: {e}")
+        return pd.DataFrame(columns=list(NUTRIENTS), dtype=np.float64)
+
+def plot_nutrition_histogram(history):
     """Plot histogram of key nutrients from past scans."""
-    nutrients = ["calories", "protein", "fat", "carbs", "sugar", "fiber"]
+    import matplotlib.pyplot as plt
     fig, axes = plt.subplots(2, 3, figsize=(15, 8))
     axes = axes.flatten()
-    for i, nutrient in enumerate(nutrients):
-        values = [item.get(nutrient, 0) for item in db["barcodes"].values()]
-        if values:
-            axes[i].hist(values, bins=10, color=["skyblue", "lightgreen", "salmon", "gold", "violet", "lime"][i % 6])
+    for i, nutrient in enumerate(NUTRIENTS):
+        values = history[nutrient].values
+        if values.size:
+            axes[i].hist(values, bins=10, color=HIST_COLORS[i])
             axes[i].set_title(f"{nutrient.capitalize()} Distribution")
             axes[i].set_xlabel(f"{nutrient.capitalize()} (g/100g except cal)")
-    plt.tight_layout()
-    st.pyplot(fig)
+    fig.tight_layout()
+    # Detach from pyplot so cached figures don't accumulate as open figures
+    plt.close(fig)
+    return fig
+
+def get_db_version():
+    """Cheap fingerprint of the barcodes table; INSERT OR REPLACE always assigns a new rowid."""
+    return tuple(get_db_connection().execute("SELECT COUNT(*), MAX(rowid) FROM barcodes").fetchone())
+
+@st.cache_data(max_entries=1)
+def compute_defaults(db_version):
+    """Slider defaults from past scans, recomputed only when db_version changes."""
+    defaults = {"calories": 400, "protein": 2, "fat": 5, "carbs": 90, "sugar": 10, "fiber": 1}
+    try:
+        # One columnar reduction in SQLite; NULLs count as 0 like in the history DataFrame
+        averages = ", ".join(f"AVG(COALESCE({n}, 0))" for n in NUTRIENTS)
+        row = get_db_connection().execute(f"SELECT COUNT(*), {averages} FROM barcodes").fetchone()
+        if row[0]:
+            defaults = dict(zip(NUTRIENTS, row[1:]))
+    except Exception as e:
+        logging.error(f"Failed to compute slider defaults: {e}")
+    return defaults
+
+@st.cache_data(max_entries=1)
+def render_history(db_version):
+    """Rendered history PNG, recomputed only when db_version changes."""
+    # Cache the rendered image; handing the figure to st.pyplot would re-run savefig every rerun
+    png = io.BytesIO()
+    plot_nutrition_histogram(load_scan_history()).savefig(png, format="png", dpi=200, bbox_inches="tight")
+    return png.getvalue()
 
 def main():
     """Main Streamlit app."""
@@ -141,16 +449,8 @@ def main():
     st.write("Note: Adjust sliders based on scan results or label values.")
 
     st.subheader("Nutritional Preferences")
-    db = load_nutrition_db()
-    avg_nutrients = {k: np.mean([item.get(k, 0) for item in db["barcodes"].values()]) for k in ["calories", "protein", "fat", "carbs", "sugar", "fiber"]}
-    defaults = {
-        "calories": avg_nutrients["calories"] if db["barcodes"] else 400,
-        "protein": avg_nutrients["protein"] if db["barcodes"] else 2,
-        "fat": avg_nutrients["fat"] if db["barcodes"] else 5,
-        "carbs": avg_nutrients["carbs"] if db["barcodes"] else 90,
-        "sugar": avg_nutrients["sugar"] if db["barcodes"] else 10,
-        "fiber": avg_nutrients["fiber"] if db["barcodes"] else 1
-    }
+    db_version = get_db_version()
+    defaults = compute_defaults(db_version)
     max_calories = st.slider("Max Calories per Serving", 100, 1500, int(defaults["calories"]), 10)
     min_protein = st.slider("Min Protein per Serving (g)", 0, 50, int(defaults["protein"]), 1)
     max_fat = st.slider("Max Fat per Serving (g)", 0, 50, int(defaults["fat"]), 1)
@@ -159,7 +459,7 @@ def main():
     min_fiber = st.slider("Min Fiber per Serving (g)", 0, 20, int(defaults["fiber"]), 1)
 
     st.subheader("Scan History")
-    plot_nutrition_histogram(db)
+    st.image(render_history(db_version), use_container_width=True)
 
     st.subheader("Upload Barcode Image")
     uploaded_file = st.file_uploader("Choose an image (JPG)", type=["jpg", "jpeg"])
@@ -170,8 +470,9 @@ def main():
             st.image(uploaded_file, caption="Uploaded Barcode", use_container_width=True)
             
             # Read image
-            file_bytes = np.asarray(bytearray(uploaded_file.read()), dtype=np.uint8)
-            image = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
+            # getvalue() ignores the read position left by st.image, and frombuffer avoids a copy
+            file_bytes = np.frombuffer(uploaded_file.getvalue(), dtype=np.uint8)
+            image = cv2.imdecode(file_bytes, cv2.IMREAD_GRAYSCALE)
             if image is None:
                 st.error("Failed to read image. Try another file.")
                 logging.error("Failed to read uploaded image")
@@ -182,11 +483,13 @@ def main():
             
             # Display result
             if result:
+                import pandas as pd
                 st.success(f"Found: {result.get('name')}")
                 # Display as table
-                df = pd.DataFrame([result], columns=["name", "calories", "fat", "carbs", "protein", "sugar", "fiber"])
+                df = pd.DataFrame([result], columns=RESULT_COLUMNS)
                 st.table(df)
-                meets_criteria, mismatches = check_nutrition(result, max_calories, min_protein, max_fat, max_carbs, max_sugar, min_fiber)
+                check = make_checker(max_calories, min_protein, max_fat, max_carbs, max_sugar, min_fiber)
+                meets_criteria, mismatches = check(result)
                 if meets_criteria:
                     st.write("✅ Meets your preferences!")
                 else:
@@ -197,7 +500,13 @@ def main():
                         st.warning("No specific mismatch details available. Check image or sliders.")
                 # Export option
                 if st.button("Export Results"):
-                    df.to_csv("scan_results.csv", index=False)
+                    # Append so earlier exports are kept; header only for a new file
+                    header_needed = not os.path.exists("scan_results.csv")
+                    with open("scan_results.csv", "a", newline="", encoding="utf-8") as f:
+                        writer = csv.writer(f)
+                        if header_needed:
+                            writer.writerow(RESULT_COLUMNS)
+                        writer.writerow([result.get(c, "") for c in RESULT_COLUMNS])
                     st.success("Exported to scan_results.csv!")
             else:
                 st.error("Barcode not recognized. Check nutriscan.log for details.")